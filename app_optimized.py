@@ -1,12 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, current_app, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-import base64
-import io
+from werkzeug.exceptions import RequestEntityTooLarge
+import binascii
 import logging
 import os
+import queue
+import threading
 import time
-from PIL import Image
+from concurrent.futures import Future
 import numpy as np
+import cv2
+import orjson
+import pybase64
+import tensorflow as tf
 from deepface import DeepFace
 
 # Configure logging
@@ -16,39 +23,356 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Keep per-process thread pools small so gunicorn workers don't oversubscribe
+# the CPU. TensorFlow only accepts this before its runtime is initialized.
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', 2))
+tf.config.threading.set_intra_op_parallelism_threads(INFERENCE_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(1)
+cv2.setNumThreads(1)
+
+class ORJSONProvider(JSONProvider):
+    """Serialize jsonify() responses and parse request JSON with orjson"""
+    
+    # Same default as Flask's DefaultJSONProvider
+    sort_keys = True
+    
+    def _dumps_bytes(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=kwargs.get('default'), option=option)
+    
+    def dumps(self, obj, **kwargs):
+        return self._dumps_bytes(obj, **kwargs).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Same argument handling as jsonify(): one positional value, several
+        # positional values as a list, or keyword arguments as a dict
+        if args and kwargs:
+            raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+        if not args and not kwargs:
+            obj = None
+        elif len(args) == 1:
+            obj = args[0]
+        else:
+            obj = list(args) if args else kwargs
+        
+        # Hand orjson's bytes straight to the response without a str round trip
+        return current_app.response_class(
+            self._dumps_bytes(obj),
+            mimetype='application/json'
+        )
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Reject oversized uploads before they are read into memory. The body
+# limit allows for base64's 4/3 expansion plus room for the JSON wrapper
+# and data URL prefix, so MAX_IMAGE_BYTES is the decoded image limit.
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_BYTES * 4 // 3 + 64 * 1024
 
-# Configure CORS with specific settings
+# Configure CORS with explicit origins (same allowlist as app.py)
 CORS(app, resources={
     r"/*": {
-        "origins": "*",
+        "origins": [
+            "https://monumental-toffee-c08772.netlify.app",
+            "http://localhost:5173",
+            "http://localhost:3000"
+        ],
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type"]
+        "allow_headers": ["Content-Type"],
+        "supports_credentials": False
     }
 })
 
-# Flag to track if models are warmed up
-models_warmed_up = False
+# Class order of DeepFace's FER-2013 emotion model output
+EMOTION_LABELS = ('angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral')
+
+# Inference backend: 'onnx' / 'tflite' use the models produced by
+# convert_model.py, 'keras' runs DeepFace's model as-is. Defaults to the
+# first converted model found on disk.
+EMOTION_ONNX_PATH = os.environ.get('EMOTION_ONNX_PATH', 'emotion.onnx')
+EMOTION_TFLITE_PATH = os.environ.get('EMOTION_TFLITE_PATH', 'emotion_int8.tflite')
+
+def _default_backend():
+    if os.path.exists(EMOTION_ONNX_PATH):
+        return 'onnx'
+    if os.path.exists(EMOTION_TFLITE_PATH):
+        return 'tflite'
+    return 'keras'
+
+EMOTION_BACKEND = os.environ.get('EMOTION_BACKEND', _default_backend())
+
+class OnnxEmotionModel:
+    """ONNX Runtime emotion model exposing a Keras-style predict()"""
+    
+    def __init__(self, model_path, num_threads=INFERENCE_THREADS):
+        import onnxruntime as ort
+        
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+    
+    def predict(self, batch, verbose=0):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+class KerasEmotionModel:
+    """DeepFace's Keras emotion model with an XLA-compiled forward pass"""
+    
+    # XLA compiles one executable per input shape, so batches are padded
+    # up to these sizes (the largest matches MAX_BATCH_FACES) and each one
+    # is compiled up front rather than on the request path
+    BATCH_BUCKETS = (1, 2, 4, 8, 16)
+    
+    def __init__(self):
+        self.model = DeepFace.build_model(
+            model_name='Emotion',
+            task='facial_attribute'
+        ).model
+        
+        # Calling the model through a traced tf.function skips the per-call
+        # data adapter and eager dispatch overhead of Model.predict
+        @tf.function(
+            input_signature=[tf.TensorSpec([None, 48, 48, 1], tf.float32)],
+            jit_compile=True
+        )
+        def infer(x):
+            return self.model(x, training=False)
+        
+        self._infer = infer
+        for size in self.BATCH_BUCKETS:
+            self._infer(tf.zeros([size, 48, 48, 1], tf.float32))
+    
+    def predict(self, batch, verbose=0):
+        largest = self.BATCH_BUCKETS[-1]
+        if len(batch) > largest:
+            return np.concatenate([
+                self.predict(batch[i:i + largest])
+                for i in range(0, len(batch), largest)
+            ])
+        
+        size = next(b for b in self.BATCH_BUCKETS if b >= len(batch))
+        padded = np.zeros((size, 48, 48, 1), dtype=np.float32)
+        padded[:len(batch)] = batch
+        return self._infer(tf.constant(padded)).numpy()[:len(batch)]
+
+class TFLiteEmotionModel:
+    """INT8 TFLite emotion model exposing a Keras-style predict()"""
+    
+    def __init__(self, model_path, num_threads=INFERENCE_THREADS):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
+        
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_shape = tuple(self.interpreter.get_input_details()[0]['shape'])
+    
+    def predict(self, batch, verbose=0):
+        # Only reallocate when the batch size changes
+        if batch.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = batch.shape
+        
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+# Emotion model is built once per process and shared by all requests
+EMOTION_MODEL = None
+
+# CascadeClassifier.detectMultiScale stores the image in the classifier, so
+# it isn't thread-safe; each gthread request thread gets its own instance
+FACE_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+_cascade_local = threading.local()
+
+def get_face_cascade():
+    """Return this thread's face detector, loading it on first use"""
+    cascade = getattr(_cascade_local, 'cascade', None)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(FACE_CASCADE_PATH)
+        _cascade_local.cascade = cascade
+    return cascade
 
 def warmup_models():
-    """Warm up the DeepFace model"""
-    global models_warmed_up
-    if not models_warmed_up:
+    """Build the emotion model once and run a dummy prediction"""
+    global EMOTION_MODEL
+    if EMOTION_MODEL is None:
         try:
-            logger.info("🔥 Warming up DeepFace models...")
-            # Create a dummy image to initialize models
-            dummy_img = np.zeros((224, 224, 3), dtype=np.uint8)
-            DeepFace.analyze(
-                img_path=dummy_img,
-                actions=['emotion'],
-                enforce_detection=False,
-                detector_backend='opencv',
-                silent=True
-            )
-            models_warmed_up = True
+            logger.info(f"🔥 Warming up emotion model ({EMOTION_BACKEND})...")
+            if EMOTION_BACKEND == 'onnx':
+                model = OnnxEmotionModel(EMOTION_ONNX_PATH)
+            elif EMOTION_BACKEND == 'tflite':
+                model = TFLiteEmotionModel(EMOTION_TFLITE_PATH)
+            else:
+                model = KerasEmotionModel()
+            # Run a dummy prediction to initialize the graph
+            model.predict(np.zeros((1, 48, 48, 1), dtype=np.float32), verbose=0)
+            # Only publish the model once it has run successfully
+            EMOTION_MODEL = model
             logger.info("✅ Models loaded successfully!")
         except Exception as e:
-            logger.warning(f"⚠️ Warmup failed: {e}")
+            logger.error(f"❌ Warmup failed, will retry on next request: {e}")
+
+# Longest side of the image the face detector runs on
+DETECTION_SIZE = 320
+
+# Most faces classified per image; crowd photos keep the largest ones
+MAX_FACES = 8
+
+def detect_faces(gray):
+    """
+    Find faces in a grayscale image and return up to MAX_FACES of them
+    as crops, largest first. Detection runs on a copy downscaled to
+    DETECTION_SIZE and the boxes are mapped back to crop from the
+    full-resolution image. Falls back to the whole image when no face is
+    found, like enforce_detection=False in DeepFace.
+    
+    Unlike DeepFace.analyze, crops are not eye-aligned (align=True) nor
+    padded to 224x224 before the 48x48 resize, so scores can differ
+    from what DeepFace.analyze reports for the same image.
+    """
+    det_scale = min(1.0, DETECTION_SIZE / max(gray.shape[:2]))
+    if det_scale < 1.0:
+        det_gray = cv2.resize(
+            gray, None, fx=det_scale, fy=det_scale, interpolation=cv2.INTER_AREA
+        )
+    else:
+        det_gray = gray
+    
+    faces = get_face_cascade().detectMultiScale(det_gray, scaleFactor=1.1, minNeighbors=10)
+    
+    if len(faces) == 0:
+        return [gray]
+    
+    crops = []
+    for face in sorted(faces, key=lambda f: f[2] * f[3], reverse=True)[:MAX_FACES]:
+        x, y, w, h = (int(v / det_scale) for v in face)
+        crops.append(gray[y:y + h, x:x + w])
+    return crops
+
+# Micro-batching: faces from concurrent requests are coalesced into one
+# forward pass of at most MAX_BATCH_FACES faces. The worker never waits for
+# a batch to fill; it takes whatever is already queued, and requests that
+# arrive while the model runs are picked up together by the next batch.
+MAX_BATCH_FACES = 16
+
+_batch_queue = queue.Queue()
+_batch_thread = None
+_batch_lock = threading.Lock()
+
+def _batch_worker():
+    """Drain queued face tensors and run them through the model together"""
+    carry = None
+    while True:
+        items = [carry if carry is not None else _batch_queue.get()]
+        carry = None
+        total_faces = len(items[0][0])
+        
+        while total_faces < MAX_BATCH_FACES:
+            try:
+                item = _batch_queue.get_nowait()
+            except queue.Empty:
+                break
+            if total_faces + len(item[0]) > MAX_BATCH_FACES:
+                # Doesn't fit; it starts the next batch
+                carry = item
+                break
+            items.append(item)
+            total_faces += len(item[0])
+        
+        try:
+            # Retry a warmup that failed at startup (e.g. a weights download)
+            if EMOTION_MODEL is None:
+                warmup_models()
+            if EMOTION_MODEL is None:
+                raise RuntimeError('Emotion model is not loaded')
+            
+            batch = np.concatenate([faces for faces, _ in items])
+            predictions = EMOTION_MODEL.predict(batch, verbose=0)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            continue
+        
+        start = 0
+        for faces, future in items:
+            future.set_result(predictions[start:start + len(faces)])
+            start += len(faces)
+
+def run_batched(faces):
+    """Queue a (N, 48, 48, 1) face tensor and wait for its predictions"""
+    global _batch_thread
+    with _batch_lock:
+        # Threads don't survive fork, so each gunicorn worker starts its own
+        if _batch_thread is None or not _batch_thread.is_alive():
+            _batch_thread = threading.Thread(target=_batch_worker, daemon=True)
+            _batch_thread.start()
+    
+    future = Future()
+    _batch_queue.put((faces, future))
+    return future.result()
+
+# Folds the model's EMOTION_LABELS probabilities into happy/neutral/sad,
+# counting angry and fear partially towards sad
+SUMMARY_WEIGHTS = {
+    'happy': {'happy': 1.0},
+    'neutral': {'neutral': 1.0},
+    'sad': {'sad': 1.0, 'angry': 0.5, 'fear': 0.3},
+}
+SUMMARY_LABELS = tuple(SUMMARY_WEIGHTS)
+
+_W = np.zeros((len(SUMMARY_LABELS), len(EMOTION_LABELS)), dtype=np.float32)
+for row, weights in enumerate(SUMMARY_WEIGHTS.values()):
+    for label, weight in weights.items():
+        _W[row, EMOTION_LABELS.index(label)] = weight
+
+_INV_255 = np.float32(1 / 255)
+
+def predict_emotions(faces_gray):
+    """
+    Run the emotion model on grayscale face crops in a single batch,
+    returning happy/neutral/sad percentages as an (N, 3) array
+    """
+    batch = np.stack([
+        cv2.resize(face, (48, 48)) for face in faces_gray
+    ]).astype(np.float32)[..., None]
+    batch *= _INV_255
+    
+    predictions = run_batched(batch)
+    predictions = predictions / predictions.sum(axis=1, keepdims=True)
+    return 100 * predictions @ _W.T
+
+def summarize_emotions(scores):
+    """Pick the dominant happy/neutral/sad emotion for each row of scores"""
+    return [
+        (
+            SUMMARY_LABELS[i],
+            round(float(row[i]) / 100, 2),
+            dict(zip(SUMMARY_LABELS, row.tolist()))
+        )
+        for i, row in zip(scores.argmax(axis=1).tolist(), scores)
+    ]
+
+# Load models at startup so the first request doesn't pay for it. Under
+# gunicorn this runs in each worker after fork (preload_app is off), since
+# the inference runtimes' thread pools are not fork-safe.
+warmup_models()
 
 @app.route('/', methods=['GET'])
 def home():
@@ -84,77 +408,66 @@ def detect_emotion():
     if request.method == 'OPTIONS':
         return '', 204
     
-    # Warm up models on first request
-    warmup_models()
-    
-    start_time = time.time()
+    start_ns = time.perf_counter_ns()
     
     try:
+        # Parse the body with orjson; get_data is bounded by MAX_CONTENT_LENGTH
+        try:
+            payload = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            logger.warning("Invalid JSON in request")
+            return jsonify({'error': 'Invalid JSON'}), 400
+        
         # Validate request
-        if not request.json or 'image' not in request.json:
+        if not isinstance(payload, dict) or not isinstance(payload.get('image'), str):
             logger.warning("Missing image data in request")
             return jsonify({'error': 'Missing image data'}), 400
         
         # Decode base64 image
-        img_data_url = request.json['image']
+        img_data_url = payload['image']
         
         # Handle both formats: with and without data URL prefix
-        if ',' in img_data_url:
-            img_base64 = img_data_url.split(',')[1]
-        else:
-            img_base64 = img_data_url
+        comma = img_data_url.find(',')
+        img_base64 = img_data_url[comma + 1:] if comma >= 0 else img_data_url
+        
+        # Every 4 base64 characters decode to 3 bytes
+        if len(img_base64) * 3 // 4 > MAX_IMAGE_BYTES:
+            logger.warning("Image payload too large")
+            raise RequestEntityTooLarge()
         
         try:
-            img_bytes = base64.b64decode(img_base64)
-        except Exception as e:
+            img_bytes = pybase64.b64decode(img_base64, validate=False)
+        except (binascii.Error, ValueError) as e:
             logger.error(f"Base64 decode error: {e}")
             return jsonify({'error': 'Invalid base64 image data'}), 400
         
-        # Open and convert image
-        img = Image.open(io.BytesIO(img_bytes))
-        
-        # Convert to RGB if necessary
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
+        # Both the face detector and the emotion model work on grayscale, so
+        # decode straight to one channel and skip the colour conversion
+        img_array = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img_array is None:
+            logger.error("Image decode error")
+            return jsonify({'error': 'Invalid image data'}), 400
         
         # Resize if too large (optional optimization)
         max_size = 1024
-        if img.width > max_size or img.height > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        img_array = np.array(img)
-        
-        # Analyze with DeepFace
-        result = DeepFace.analyze(
-            img_path=img_array,
-            actions=['emotion'],
-            enforce_detection=False,
-            detector_backend='opencv',
-            silent=True
-        )
-        
-        # Handle list or dict response
-        if isinstance(result, list):
-            result = result[0]
-        
-        emotions = result.get('emotion', {})
-        
-        # Map to 3 categories: happy, neutral, sad
-        emotion_mapping = {
-            'happy': float(emotions.get('happy', 0)),
-            'neutral': float(emotions.get('neutral', 0)),
-            'sad': float(
-                emotions.get('sad', 0) + 
-                emotions.get('angry', 0) * 0.5 + 
-                emotions.get('fear', 0) * 0.3
+        height, width = img_array.shape[:2]
+        longest = max(height, width)
+        if longest > max_size:
+            # Integer target size avoids float rounding drift in the scale
+            new_w = max(1, width * max_size // longest)
+            new_h = max(1, height * max_size // longest)
+            img_array = cv2.resize(
+                img_array, (new_w, new_h), interpolation=cv2.INTER_AREA
             )
-        }
         
-        # Get dominant emotion
-        dominant_emotion = max(emotion_mapping, key=emotion_mapping.get)
-        confidence = round(emotion_mapping[dominant_emotion] / 100, 2)
+        # Detect faces and classify them together in one batch
+        faces = detect_faces(img_array)
+        results = summarize_emotions(predict_emotions(faces))
+        
+        # The largest face is reported as the primary result
+        dominant_emotion, confidence, emotion_mapping = results[0]
         
-        processing_time = round((time.time() - start_time) * 1000, 2)
+        processing_time = round((time.perf_counter_ns() - start_ns) / 1e6, 2)
         
         logger.info(
             f"✅ Emotion: {dominant_emotion} "
@@ -165,11 +478,17 @@ def detect_emotion():
             'emotion': dominant_emotion,
             'confidence': confidence,
             'processing_time_ms': processing_time,
-            'all_emotions': emotion_mapping
+            'all_emotions': emotion_mapping,
+            'faces': [
+                {'emotion': emotion, 'confidence': face_confidence}
+                for emotion, face_confidence, _ in results
+            ]
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
-        processing_time = round((time.time() - start_time) * 1000, 2)
+        processing_time = round((time.perf_counter_ns() - start_ns) / 1e6, 2)
         logger.error(f"❌ Error processing image: {e}")
         
         # Return neutral with error info
@@ -188,6 +507,15 @@ def not_found(error):
         'available_endpoints': ['/', '/health', '/detect-emotion']
     }), 404
 
+@app.errorhandler(413)
+def request_too_large(error):
+    """Handle payloads over MAX_CONTENT_LENGTH"""
+    logger.warning("Request body too large")
+    return jsonify({
+        'error': 'Image too large',
+        'max_bytes': MAX_IMAGE_BYTES
+    }), 413
+
 @app.errorhandler(500)
 def internal_error(error):
     """Handle 500 errors"""
@@ -0,0 +1,153 @@
+"""
+One-time conversion of DeepFace's emotion model for faster CPU inference
+
+Usage:
+    python convert_model.py tflite --calibration-dir faces/ [--output emotion_int8.tflite] [--force]
+    python convert_model.py onnx [--output emotion.onnx]   # requires tf2onnx
+
+The converted file is picked up by app_optimized.py at startup
+(see EMOTION_BACKEND / EMOTION_TFLITE_PATH / EMOTION_ONNX_PATH).
+These runtimes are optional and not in requirements.txt; install the one
+you deploy with:
+    pip install onnxruntime      # to serve emotion.onnx
+    pip install tflite-runtime   # optional for emotion_int8.tflite, falls
+                                 # back to TensorFlow's tf.lite.Interpreter
+"""
+
+import argparse
+import logging
+import os
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from deepface import DeepFace
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CALIBRATION_SAMPLES = 200
+
+# Refuse to save an INT8 model that agrees with the Keras model on fewer faces
+MIN_AGREEMENT = 0.95
+
+def load_emotion_model():
+    """Build DeepFace's Keras emotion model"""
+    return DeepFace.build_model(
+        model_name='Emotion',
+        task='facial_attribute'
+    ).model
+
+def calibration_faces(calibration_dir):
+    """
+    Load up to CALIBRATION_SAMPLES images from calibration_dir (ideally
+    face crops) as 48x48 grayscale tensors in [0, 1]
+    """
+    faces = []
+    for name in sorted(os.listdir(calibration_dir))[:CALIBRATION_SAMPLES]:
+        img = cv2.imread(os.path.join(calibration_dir, name), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            continue
+        face = cv2.resize(img, (48, 48)).astype(np.float32) / 255.0
+        faces.append(face[None, ..., None])
+
+    if not faces:
+        raise ValueError(f"No readable images in {calibration_dir}")
+    return faces
+
+def top1_agreement(model, tflite_model, faces):
+    """Fraction of faces where the TFLite and Keras models pick the same class"""
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    interpreter.allocate_tensors()
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+
+    keras_top1 = model.predict(np.concatenate(faces), verbose=0).argmax(axis=1)
+    tflite_top1 = []
+    for face in faces:
+        interpreter.set_tensor(input_index, face)
+        interpreter.invoke()
+        tflite_top1.append(interpreter.get_tensor(output_index).argmax())
+
+    return float(np.mean(keras_top1 == np.array(tflite_top1)))
+
+def convert_tflite(output_path, calibration_dir, force=False):
+    """Quantize the emotion model to an INT8 TFLite flatbuffer"""
+    model = load_emotion_model()
+    faces = calibration_faces(calibration_dir)
+
+    def representative_dataset():
+        for face in faces:
+            yield [face]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+
+    agreement = top1_agreement(model, tflite_model, faces)
+    logger.info(
+        f"Top-1 agreement with the Keras model: {agreement:.1%} "
+        f"on {len(faces)} calibration images"
+    )
+    if agreement < MIN_AGREEMENT:
+        if not force:
+            # app_optimized.py loads this file automatically when it exists
+            raise SystemExit(
+                f"❌ Agreement is below {MIN_AGREEMENT:.0%}, not saving {output_path}. "
+                f"Check the calibration images or pass --force."
+            )
+        logger.warning(f"⚠️ Agreement is below {MIN_AGREEMENT:.0%}, saving anyway (--force)")
+
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    logger.info(f"✅ Saved INT8 TFLite model to {output_path}")
+
+def convert_onnx(output_path, opset=17):
+    """Export the emotion model to ONNX with a dynamic batch dimension"""
+    import tf2onnx
+
+    model = load_emotion_model()
+    input_signature = (tf.TensorSpec((None, 48, 48, 1), tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(
+        model,
+        input_signature=input_signature,
+        opset=opset,
+        output_path=output_path
+    )
+    logger.info(f"✅ Saved ONNX model to {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='format', required=True)
+
+    tflite_parser = subparsers.add_parser('tflite', help='INT8 TFLite model')
+    tflite_parser.add_argument('--output', default='emotion_int8.tflite')
+    tflite_parser.add_argument(
+        '--calibration-dir',
+        required=True,
+        help='Directory of face images used to calibrate INT8 ranges'
+    )
+    tflite_parser.add_argument(
+        '--force',
+        action='store_true',
+        help=f'Save even if top-1 agreement is below {MIN_AGREEMENT:.0%}'
+    )
+
+    onnx_parser = subparsers.add_parser('onnx', help='ONNX model for onnxruntime')
+    onnx_parser.add_argument('--output', default='emotion.onnx')
+    onnx_parser.add_argument('--opset', type=int, default=17)
+
+    args = parser.parse_args()
+
+    if args.format == 'tflite':
+        convert_tflite(args.output, args.calibration_dir, args.force)
+    elif args.format == 'onnx':
+        convert_onnx(args.output, args.opset)
+
+if __name__ == '__main__':
+    main()
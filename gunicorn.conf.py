@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration for the Emotion Detection API
+
+The app is not preloaded: TensorFlow, ONNX Runtime and TFLite start
+thread pools when a model is built, and those do not survive fork. Each
+worker imports the app, and so builds its own model, after it is forked.
+"""
+
+import os
+
+# Pin TensorFlow to CPU when the host has no GPU. Workers inherit the
+# environment, so this applies before each of them imports TensorFlow.
+if not os.path.exists('/dev/nvidia0'):
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+
+# Cap the threads each worker's TensorFlow/OpenMP runtime spawns so several
+# workers don't oversubscribe the CPU.
+os.environ.setdefault('INFERENCE_THREADS', '2')
+os.environ.setdefault('OMP_NUM_THREADS', os.environ['INFERENCE_THREADS'])
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+preload_app = False
+worker_class = 'gthread'
+# Each worker holds its own copy of the model, so keep the previous default
+# of 2 (fits the 512MB Render free plan); raise via WEB_CONCURRENCY
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = 120
+loglevel = 'info'
+
+
+def post_fork(server, worker):
+    """Log each worker as it is forked, before it loads the app"""
+    server.log.info(
+        f"Worker {worker.pid} forked "
+        f"(CUDA_VISIBLE_DEVICES={os.environ.get('CUDA_VISIBLE_DEVICES', 'all')})"
+    )
@@ -31,12 +31,14 @@ def test_health():
 def create_test_image():
     """Create a simple test image"""
     # Create a simple RGB image (224x224 with a gradient)
-    img = np.zeros((224, 224, 3), dtype=np.uint8)
-    
-    # Add some pattern
-    for i in range(224):
-        for j in range(224):
-            img[i, j] = [i % 256, j % 256, (i+j) % 256]
+    # uint8 arithmetic wraps mod 256, so (i + j) needs no explicit modulo
+    i = np.arange(224, dtype=np.uint8)[:, None]
+    j = np.arange(224, dtype=np.uint8)[None, :]
+    img = np.stack([
+        np.broadcast_to(i, (224, 224)),
+        np.broadcast_to(j, (224, 224)),
+        i + j
+    ], axis=-1)
     
     # Convert to PIL Image
     pil_img = Image.fromarray(img)
@@ -48,19 +50,18 @@ def create_test_image():
     
     return f"data:image/jpeg;base64,{img_base64}"
 
+# Encode the test image once and reuse it for every request
+_TEST_IMAGE_DATAURL = create_test_image()
+
 def test_emotion_detection():
     """Test the emotion detection endpoint"""
     print("\n🧪 Testing emotion detection endpoint...")
     try:
-        # Create test image
-        print("   Creating test image...")
-        test_img = create_test_image()
-        
         # Send request
         print("   Sending request to API...")
         response = requests.post(
             f"{API_URL}/detect-emotion",
-            json={"image": test_img},
+            json={"image": _TEST_IMAGE_DATAURL},
             timeout=30
         )
         